@@ -1,81 +1,208 @@
 import datasets
 import torch
 import numpy as np
-from safetensors.torch import save
-from snappy import compress
+from safetensors.torch import save_file
+import zstandard
+import threading
+import math
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+from turbojpeg import TurboJPEG, TJPF_RGB
 from tqdm import tqdm
-#Pillow
+#PyTurboJPEG (libjpeg-turbo), opencv-python
+
+# Format: (Width, Height) because cv2 uses (W, H)
+SIZE = (128, 128)
+
+jpeg = TurboJPEG()
+
+ZSTD_LEVEL = 3
+
+# ZstdCompressor objects must not be used from several threads at once, so each thread gets its own.
+# threads=-1 lets zstd split each frame across all cores.
+_compressors = threading.local()
+
+def compress_file(path):
+    """Streams a finished shard through zstd into path + ".zst" and removes the uncompressed file."""
+    cctx = getattr(_compressors, "cctx", None)
+    if cctx is None:
+        cctx = _compressors.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+    with open(path, "rb") as src, open(path + ".zst", "wb") as dst:
+        cctx.copy_stream(src, dst, size=os.path.getsize(path))
+        drop_page_cache(dst)
+    os.remove(path)
+
+def drop_page_cache(f):
+    """Tells the kernel a finished shard won't be read back, so it doesn't crowd the dataset out of the page cache.
+
+    DONTNEED only drops clean pages, so the shard is synced to disk first.
+    """
+    f.flush()
+    os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+# --- HELPER: DECODE IN WORKER ---
+def pick_scaling_factor(width, height, target_w, target_h):
+    """Largest libjpeg-turbo IDCT downscale that still yields at least the target size."""
+    best = (1, 1)
+    for num, denom in jpeg.scaling_factors:
+        if num / denom >= best[0] / best[1]:
+            continue
+        if math.ceil(width * num / denom) >= target_w and math.ceil(height * num / denom) >= target_h:
+            best = (num, denom)
+    return best
+
+def decode_fallback(image_bytes):
+    """Decodes the handful of ImageNet files (PNG, CMYK JPEG) libjpeg-turbo can't hand back as RGB."""
+    img_arr = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB)
+
+def decode_rgb(image_bytes, target_w, target_h):
+    """Decodes a JPEG to (H, W, 3) uint8 RGB, downscaling inside the IDCT where possible."""
+    try:
+        width, height, _, _ = jpeg.decode_header(image_bytes)
+        scaling_factor = pick_scaling_factor(width, height, target_w, target_h)
+        return jpeg.decode(image_bytes, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+    except OSError:
+        return decode_fallback(image_bytes)
+
+def decode_one(image_bytes, label):
+    """Decodes and resizes a single JPEG. Runs inside a worker process."""
+    img_arr = decode_rgb(image_bytes, *SIZE)
+
+    # Finish with an area resize if the scaled decode didn't land on SIZE exactly
+    if img_arr.shape[:2] != (SIZE[1], SIZE[0]):
+        img_arr = cv2.resize(img_arr, SIZE, interpolation=cv2.INTER_AREA)
+
+    return img_arr, label
+
+def decode_resize(batch):
+    """Decodes and resizes one column batch of raw samples. Runs inside a worker process."""
+    out_imgs = []
+    out_lbls = []
+    for image, label in zip(batch['image'], batch['label']):
+        img_arr, label = decode_one(image['bytes'], label)
+        # Hand back (3, H, W) so the shard buffer is filled in NCHW order directly
+        out_imgs.append(np.ascontiguousarray(img_arr.transpose(2, 0, 1)))
+        out_lbls.append(label)
+    return {'pixels': out_imgs, 'label': out_lbls}
+
+def decode_stream(executor, batches, max_pending=16):
+    """Order-preserving executor.map of decode_resize over an endless stream of batches.
+
+    executor.map submits the whole iterable up front, which would pull the entire
+    streaming dataset into memory. Here only max_pending batches are in flight.
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(executor.submit(decode_resize, batch))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 def main():
     # --- CONFIGURATION ---
     data_dir = "data/imagenet_gan_128"
     os.makedirs(data_dir, exist_ok=True)
-    
-    # Format: (Width, Height) because PIL uses (W, H)
-    SIZE = (128, 128) 
+
     SLICE_SIZE = 2048
-    
+    NUM_WORKERS = os.cpu_count()
+    NUM_WRITERS = 4
+    # Samples per batch pulled from the dataset and decoded by one worker
+    BATCH_SIZE = 256
+    # Compress finished shards to .safetensors.zst in the background, False keeps plain .safetensors
+    COMPRESS = True
+
     # --- HELPER: FLUSH TO DISK ---
-    def flush_buffer(images, labels, slice_count):
-        """Writes the current buffer to disk and clears it."""
-    
-        # 1. Stack and Convert
-        # List of (H, W, 3) -> Tensor (N, 3, H, W)
+    def new_buffer():
+        """Preallocated shard buffer, filled in place up to 'pos'."""
+        return {
+            'images': np.empty((SLICE_SIZE, 3, SIZE[1], SIZE[0]), dtype=np.uint8),
+            'labels': np.empty(SLICE_SIZE, dtype=np.int64),
+            'pos': 0,
+        }
+
+    def flush_buffer(buf, slice_count):
+        """Writes the given buffer to disk. Runs on the write pool."""
+
+        # 1. Convert
+        # The buffer is already (N, 3, H, W), from_numpy is zero-copy
         # converting to uint8 saves massive space/time
-        batch_tensor = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).contiguous()
-        label_tensor = torch.tensor(labels, dtype=torch.int64)
-        
+        n = buf['pos']
+        batch_tensor = torch.from_numpy(buf['images'][:n])
+        label_tensor = torch.from_numpy(buf['labels'][:n])
+
         # 2. Determine Filename
         # User requested: train_{h}_{w}_{slice_count}
-        filename = os.path.join(data_dir, f"train_{slice_count}_safetensor.snappy")
-        
+        filename = os.path.join(data_dir, f"train_{slice_count}.safetensors")
+
         # 3. Save
-        # If you need snappy output, use this instead:
-        with open(filename, "wb") as f:
-            f.write(compress(save({"images": batch_tensor, "labels": label_tensor})))
+        # save_file writes header and tensors straight to the file, no serialized copy in RAM
+        save_file({"images": batch_tensor, "labels": label_tensor}, filename)
+        if COMPRESS:
+            # The compressor reads the shard right back, so its pages stay cached until then
+            writes.append(compress_pool.submit(compress_file, filename))
+        else:
+            with open(filename, "rb") as f:
+                drop_page_cache(f)
+
+    # Serialization and the write run on a thread pool so the ingest loop keeps going.
+    # The semaphore caps how many shards are held in memory at once. Compression is a
+    # separate stage that reads the closed file back, so it never holds a shard in RAM.
+    write_pool = ThreadPoolExecutor(max_workers=NUM_WRITERS)
+    compress_pool = ThreadPoolExecutor(max_workers=1)
+    write_slots = threading.BoundedSemaphore(NUM_WRITERS)
+    writes = []
+
+    def submit_flush(buf, slice_count):
+        write_slots.acquire()
+        future = write_pool.submit(flush_buffer, buf, slice_count)
+        future.add_done_callback(lambda _: write_slots.release())
+        writes.append(future)
 
-    
     # --- MAIN LOOP ---
     # streaming=True ensures we process one sample at a time without loading everything
     print("Loading streaming dataset...")
     ds = datasets.load_dataset("ILSVRC/imagenet-1k", split="train", streaming=True, token="...")
+    # Keep the raw JPEG bytes, decoding happens in the worker processes
+    ds = ds.cast_column("image", datasets.Image(decode=False))
+    # Column batches keep the per-sample work in the main process down to buffer appends
+    raw_batches = ds.iter(batch_size=BATCH_SIZE)
 
     # State Management
-    images = []
-    labels = []
+    buf = new_buffer()
     slice_count = 0
-    
+
     print("Starting iteration...")
-    for i, sample in tqdm(enumerate(ds), total=1281167): # Total count for ImageNet Train
-        image = sample['image']
-        label = sample['label']
-    
-        # 1. Ensure RGB
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-        
-        # Perform resize if dimensions changed
-        image = image.resize(SIZE)
-            
-        # Convert to numpy uint8 immediately to save RAM (PIL objects are heavy)
-        img_arr = np.array(image, dtype=np.uint8)
-        
-        images.append(img_arr)
-        labels.append(label)
-        
-        # 4. Check Capacity
-        if len(images) >= SLICE_SIZE:
-            flush_buffer(images, labels, slice_count)
-            images = []
-            labels = []
-            slice_count += 1
-    
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        decoded = decode_stream(executor, raw_batches, max_pending=2 * NUM_WORKERS)
+        for batch in tqdm(decoded, total=math.ceil(1281167 / BATCH_SIZE), unit="batch", mininterval=1.0): # Total count for ImageNet Train
+            for img_arr, label in zip(batch['pixels'], batch['label']):
+                buf['images'][buf['pos']] = img_arr
+                buf['labels'][buf['pos']] = label
+                buf['pos'] += 1
+
+                # 4. Check Capacity
+                if buf['pos'] >= SLICE_SIZE:
+                    # The write pool owns the full buffer from here on
+                    submit_flush(buf, slice_count)
+                    buf = new_buffer()
+                    slice_count += 1
+
     # --- FINAL CLEANUP ---
     print("Flushing remaining buffers...")
-    flush_buffer(images, labels, slice_count)
-    
+    if buf['pos'] > 0:
+        submit_flush(buf, slice_count)
+    write_pool.shutdown(wait=True)
+    compress_pool.shutdown(wait=True)
+    # Re-raise any error from the write and compress pools
+    for future in writes:
+        future.result()
+
     print("Done.")
-    
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -4,7 +4,7 @@
 # ]
 # ///
 
-import itertools
+import math
 import os
 import random
 import shlex
@@ -21,6 +21,14 @@ def run(cmd: Sequence[str], dry_run: bool, env=None):
 
     subprocess.run(cmd, check=True, env=env)
 
+def nth_product(options: Sequence[Sequence], index: int) -> List:
+    """Returns the index-th element of itertools.product(*options) without building the product."""
+    combination = []
+    for values in reversed(options):
+        index, i = divmod(index, len(values))
+        combination.append(values[i])
+    return combination[::-1]
+
 if __name__ == "__main__":
     dry_run = False
 
@@ -41,11 +49,15 @@ if __name__ == "__main__":
 
 
     # Build target list
-    targets = []
+    target_sets = []
     for l in [0, 3, 5, 7]:
-        targets.append([w[0] for w in random.sample(workers, k=l+1)])
+        target_sets.append([w[0] for w in random.sample(workers, k=l+1)])
+
+    # Sample flat indices into the parameter grid and unravel them, the grid itself is never materialized
+    options = [worker_faults, network_delays, network_bandwidths, targeted_network_delays, targeted_network_spikes, targeted_network_losses, targeted_network_bandwidths, target_sets]
+    grid_size = math.prod(len(o) for o in options)
 
-    for (faults,  delays, bandwidths, targeted_delays,    targeted_spikes,    targeted_losses,    targeted_bandwidths, targets) in random.sample(list(itertools.product(worker_faults, network_delays, network_bandwidths, targeted_network_delays, targeted_network_spikes, targeted_network_losses, targeted_network_bandwidths, targets)), k=10):
+    for (faults,  delays, bandwidths, targeted_delays,    targeted_spikes,    targeted_losses,    targeted_bandwidths, targets) in (nth_product(options, i) for i in random.sample(range(grid_size), k=10)):
         service_namespace = f"r600w4p2_f{faults}_d{'_'.join([str(d) for d in delays])}b{bandwidths}l1td{'_'.join([str(d) for d in targeted_delays])}ts{'_'.join([str(s) for s in targeted_spikes])}tl{int(targeted_losses*100)}_tb{targeted_bandwidths}_{'_'.join(targets)}"
 
         env = os.environ.copy()
@@ -3,53 +3,119 @@ from safetensors.torch import save
 data_path = "data/c4_en/train"
 BLOCK_SIZE=512
 SLICE_SIZE=5000
+# Documents are cut at sentence ends into pieces of about this many characters
+# before tokenization, so almost every piece already fits into one block
+CHUNK_CHARS=2000
 
+import datasets
+import re
+import numpy as np
 import torch
-import torch.nn.functional as F
-from safetensors.torch import save, load
+from safetensors.torch import save
+from safetensors.numpy import load
 import os
-import snappy
+import zstandard
+from sortedcontainers import SortedList
+from transformers import GPT2TokenizerFast
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+ZSTD_LEVEL = 3
+
+# ZstdCompressor objects must not be used from several threads at once, so each thread gets its own.
+# Single-threaded: datasets.map already runs one process per core.
+_compressors = threading.local()
+
+def zstd_compress(data):
+    """Zstd-compresses data with this thread's compressor."""
+    cctx = getattr(_compressors, "cctx", None)
+    if cctx is None:
+        cctx = _compressors.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=0)
+    return cctx.compress(data)
 
-def snappy_safetensor(tensor_dict, file_path:str):
+def zstd_safetensor(tensor_dict, file_path:str, drop_cache=True):
     # I/O Compression
     tensor_data = save(tensor_dict)
     with open(file_path, 'wb') as out_file:
-        out_file.write(snappy.compress(tensor_data))
+        out_file.write(zstd_compress(tensor_data))
+        if drop_cache:
+            drop_page_cache(out_file)
+
+def drop_page_cache(f):
+    """Tells the kernel a finished shard won't be read back, so it doesn't crowd the dataset out of the page cache.
+
+    DONTNEED only drops clean pages, so the shard is synced to disk first.
+    """
+    f.flush()
+    os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+# Shards are serialized, compressed and written in the background while the next one is packed.
+# Created lazily so every datasets.map worker process gets its own pool.
+_write_pool = None
 
-def read_snappy_safetensor(file_path: str):
+def get_write_pool():
+    global _write_pool
+    if _write_pool is None:
+        _write_pool = ThreadPoolExecutor(max_workers=2)
+    return _write_pool
+
+def read_zstd_safetensor(file_path: str):
     with open(file_path, "rb") as file:
-        raw_bytes = snappy.uncompress(file.read())
+        raw_bytes = zstandard.ZstdDecompressor().decompress(file.read())
     return load(raw_bytes)
 
 
+# A sentence is everything up to and including the next ".", or a trailing piece without one
+SENTENCE_RE = re.compile(r"[^.]*\.|[^.]+")
+
+def split_text(text):
+    """Groups the sentences of a document into consecutive pieces of at most ~CHUNK_CHARS characters."""
+    if len(text) <= CHUNK_CHARS:
+        return [text]
+    chunks = []
+    start = end = 0
+    for sentence in SENTENCE_RE.finditer(text):
+        if sentence.end() - start > CHUNK_CHARS and end > start:
+            chunks.append(text[start:end])
+            start = end
+        end = sentence.end()
+    chunks.append(text[start:end])
+    return chunks
+
 def map_to_batch(batch, idx):
     # 1. Fast Tokenization
-    # We strip 'attention_mask' here immediately
+    # Long documents are pre-split at sentence ends, then all pieces go through the
+    # Rust tokenizer in one call. We strip 'attention_mask' here immediately
+    chunks = [chunk for text in batch["text"] for chunk in split_text(text)]
     raw_tokenized = tokenizer(
-        batch["text"],
+        chunks,
         add_special_tokens=True, # Adds BOS (if model has one)
         return_attention_mask=False 
     )["input_ids"]
 
-    split_value = tokenizer.encode(["."])[0]
     tokenized = []
     lengths = []
     for t in raw_tokenized:
         if len(t) <= BLOCK_SIZE - 1:
-            tokenized.append(t + [tokenizer.eos_token_id])
+            tokenized.append(t + [EOS_ID])
             lengths.append(len(t) + 1)
         else:
-            # split by . = 13
-            while len(t) > BLOCK_SIZE-1:
-                dot_pos = np.argwhere(np.array(t) == split_value)
-                if dot_pos.size == 0:
+            # Rare: a piece is still longer than a block, split by . = 13
+            # Locate all dots once and walk forward through them instead of rescanning per split
+            dots = np.flatnonzero(np.asarray(t) == SPLIT_TOKEN_ID)
+            cur = 0
+            while len(t) - cur > BLOCK_SIZE-1:
+                # Last dot that keeps the piece plus EOS within BLOCK_SIZE - 1 tokens
+                j = np.searchsorted(dots, cur + BLOCK_SIZE - 1) - 1
+                if j < 0 or dots[j] <= cur:
                     break
-                split_pos = np.max((dot_pos < (BLOCK_SIZE - 1)) * dot_pos)
-                tokenized.append(t[:split_pos] + [tokenizer.eos_token_id])
-                lengths.append(split_pos + 1)
-                t = t[split_pos+1:]
+                split_pos = int(dots[j])
+                tokenized.append(t[cur:split_pos] + [EOS_ID])
+                lengths.append(split_pos - cur + 1)
+                cur = split_pos + 1
     
-    # Sort for optimal packing (First Fit Decreasing)
+    # Sort for optimal packing (Best Fit Decreasing)
     indexed_lengths = sorted(
         [(l, i) for i, l in enumerate(lengths)], 
         key=lambda x: x[0], 
@@ -57,141 +123,149 @@ def map_to_batch(batch, idx):
     )
 
     bins = []
-    bin_space = [] 
+    # (remaining space, bin id) of every bin that still has room, ordered by space
+    bin_space = SortedList()
 
     # Packing Logic
     for length, index in indexed_lengths:
-        placed = False
-        for i in range(len(bins)):
-            # O(1) capacity check
-            if bin_space[i] >= length:
-                bins[i].append((length, index))
-                bin_space[i] -= length
-                placed = True
-                break
-        
-        if not placed:
+        # O(log n) lookup of the tightest bin that still fits
+        pos = bin_space.bisect_left((length, -1))
+        if pos < len(bin_space):
+            space, bin_id = bin_space.pop(pos)
+            bins[bin_id].append((length, index))
+            space -= length
+        else:
+            bin_id = len(bins)
             bins.append([(length, index)])
-            bin_space.append(BLOCK_SIZE - length)
+            space = BLOCK_SIZE - length
+
+        if space > 0:
+            bin_space.add((space, bin_id))
 
     # 3. Vectorized Tensor Construction
-    out_input_ids = []
-    out_position_ids = []
+    # Bins are written row by row into preallocated shard buffers.
+    # uint16 is enough for the GPT-Neo vocab (50257 < 65k) and for Position IDs (0-1024)
+    ids_buf = np.full((SLICE_SIZE, BLOCK_SIZE), EOS_ID, dtype=np.uint16)
+    pos_buf = np.zeros((SLICE_SIZE, BLOCK_SIZE), dtype=np.uint16)
+    positions = np.arange(BLOCK_SIZE, dtype=np.uint16)
+    row = 0
     slice_counter = 0
+    writes = []
 
     for _bin in bins:
-        combined_ids = []
-        combined_pos = []
+        col = 0
 
         for length, original_idx in _bin:
             # Fetch tokens
-            seq = tokenized[original_idx]
-            combined_ids.extend(seq)
+            ids_buf[row, col:col + length] = tokenized[original_idx]
             
             # --- CRITICAL: Reset Position IDs ---
             # Instead of a mask, we simply tell the model "we are back at index 0"
             # distinct sequences: [0, 1, 2] ... [0, 1, 2, 3]
-            combined_pos.extend(list(range(length)))
+            pos_buf[row, col:col + length] = positions[:length]
+            col += length
 
-        # Convert to Tensor (uint16 is enough for vocab < 65k, else use int32)
-        # Position IDs usually fit in uint16 (0-1024)
-        ids_tensor = torch.tensor(combined_ids, dtype=torch.int32) 
-        pos_tensor = torch.tensor(combined_pos, dtype=torch.int16)
+        # 4. Padding
+        # The buffers start out filled with EOS (inputs) and 0 (positions), so the
+        # tail of the block is already padded
+        row += 1
 
-        # 4. Fast Padding (F.pad)
-        # Pad both Input IDs and Position IDs to fill the 1024 block
-        pad_len = BLOCK_SIZE - ids_tensor.shape[0]
-        
-        if pad_len > 0:
-            # Pad inputs with EOS (or PAD)
-            ids_tensor = F.pad(ids_tensor, (0, pad_len), value=tokenizer.eos_token_id)
-            # Pad positions with 0 (ignored by model usually, or continue counter)
-            pos_tensor = F.pad(pos_tensor, (0, pad_len), value=0)
-            
-        out_input_ids.append(ids_tensor)
-        out_position_ids.append(pos_tensor)
-
-        if len(out_input_ids) == SLICE_SIZE:
-            file_path = f"{data_path}/train_{idx[0]}_{slice_counter}_safetensor.snappy"
-            # 5. Stack & Save
+        if row == SLICE_SIZE:
+            file_path = f"{data_path}/train_{idx[0]}_{slice_counter}_safetensor.zst"
+            # 5. Save (from_numpy is zero-copy)
             # We drop 'attention_mask' entirely
             tensor_dict = {
-                "input_ids": torch.stack(out_input_ids), 
-                "position_ids": torch.stack(out_position_ids)
+                "input_ids": torch.from_numpy(ids_buf), 
+                "position_ids": torch.from_numpy(pos_buf)
             }
     
-            snappy_safetensor(tensor_dict, file_path)
-            out_input_ids = []
-            out_position_ids = []
+            # The write pool now owns the full buffers, continue in fresh ones
+            writes.append(get_write_pool().submit(zstd_safetensor, tensor_dict, file_path))
+            ids_buf = np.full((SLICE_SIZE, BLOCK_SIZE), EOS_ID, dtype=np.uint16)
+            pos_buf = np.zeros((SLICE_SIZE, BLOCK_SIZE), dtype=np.uint16)
+            row = 0
             slice_counter += 1
 
-    if len(out_input_ids) > 0:
-        file_path = f"{data_path}/train_{idx[0]}_rest_safetensor.snappy"
-        # 5. Stack & Save
+    if row > 0:
+        file_path = f"{data_path}/train_{idx[0]}_rest_safetensor.zst"
+        # 5. Save (from_numpy is zero-copy)
         # We drop 'attention_mask' entirely
         tensor_dict = {
-            "input_ids": torch.stack(out_input_ids), 
-            "position_ids": torch.stack(out_position_ids)
+            "input_ids": torch.from_numpy(ids_buf[:row]), 
+            "position_ids": torch.from_numpy(pos_buf[:row])
         }
-        snappy_safetensor(tensor_dict, file_path)
+        # process_rest reads the rest shard straight back, keep it in the page cache
+        writes.append(get_write_pool().submit(zstd_safetensor, tensor_dict, file_path, drop_cache=False))
+
+    # Every shard of this batch has to be on disk before map moves on, re-raises write errors
+    for future in writes:
+        future.result()
 
 def process_rest(all_files):
-    # Buffers to store tensors temporarily (list of tensors is O(1) to append)
-    input_buffer = []
-    pos_buffer = []
-    buffer_length = 0
+    # Output shard buffers, allocated once and filled in place through a running row pointer
+    out_input = None
+    out_pos = None
+    row_ptr = 0
     counter = 0
+    # Writing a shard is slower than reading a rest file, the semaphore caps how many
+    # full shards wait in memory for the write pool
+    NUM_WRITERS = 2
+    write_pool = ThreadPoolExecutor(max_workers=NUM_WRITERS)
+    write_slots = threading.BoundedSemaphore(NUM_WRITERS)
+    writes = []
     
     # Loop through files
     while len(all_files) > 0:
         print(f"Files {len(all_files)} left")
         file = all_files.pop()
         
-        # 1. Read data
-        tensor_dict = read_snappy_safetensor(file)
-        
-        # 2. Append to list (Zero-copy operation)
+        # 1. Read data (as numpy arrays)
+        tensor_dict = read_zstd_safetensor(file)
         new_input = tensor_dict["input_ids"]
         new_pos = tensor_dict["position_ids"]
-        
-        input_buffer.append(new_input)
-        pos_buffer.append(new_pos)
-        buffer_length += new_input.shape[0]
+
+        if out_input is None:
+            out_input = np.empty((SLICE_SIZE, BLOCK_SIZE), dtype=new_input.dtype)
+            out_pos = np.empty((SLICE_SIZE, BLOCK_SIZE), dtype=new_pos.dtype)
     
-        # 3. Process only when we have enough data for at least one slice
-        while buffer_length >= SLICE_SIZE:
-            # Concatenate everything currently in the buffer
-            # This is the ONLY time we allocate heavy memory
-            full_input = torch.cat(input_buffer, dim=0)
-            full_pos = torch.cat(pos_buffer, dim=0)
-            
-            # 4. Extract the exact slice we need
-            save_input = full_input[:SLICE_SIZE]
-            save_pos = full_pos[:SLICE_SIZE]
-            
-            # 5. Save the slice
-            file_path = f"{data_path}/train_{counter}_safetensor.snappy"
-            out_dict = {
-                "input_ids": save_input,
-                "position_ids": save_pos
-            }
-            snappy_safetensor(out_dict, file_path)
-            counter += 1
-            
-            # 6. Handle the remainder
-            # We keep ONLY the leftover data in the buffer
-            remainder_input = full_input[SLICE_SIZE:]
-            remainder_pos = full_pos[SLICE_SIZE:]
-            
-            # Reset buffers with just the remainder
-            input_buffer = [remainder_input]
-            pos_buffer = [remainder_pos]
-            buffer_length = remainder_input.shape[0]
+        # 2. Copy rows straight into the output shard, every byte is copied exactly once
+        offset = 0
+        while offset < new_input.shape[0]:
+            take = min(SLICE_SIZE - row_ptr, new_input.shape[0] - offset)
+            out_input[row_ptr:row_ptr + take] = new_input[offset:offset + take]
+            out_pos[row_ptr:row_ptr + take] = new_pos[offset:offset + take]
+            row_ptr += take
+            offset += take
+
+            # 3. Save the slice once it is full
+            if row_ptr == SLICE_SIZE:
+                file_path = f"{data_path}/train_{counter}_safetensor.zst"
+                out_dict = {
+                    "input_ids": torch.from_numpy(out_input),
+                    "position_ids": torch.from_numpy(out_pos)
+                }
+                # Hand the full shard to the write pool and continue in fresh buffers
+                write_slots.acquire()
+                future = write_pool.submit(zstd_safetensor, out_dict, file_path)
+                future.add_done_callback(lambda _: write_slots.release())
+                writes.append(future)
+                out_input = np.empty_like(out_input)
+                out_pos = np.empty_like(out_pos)
+                counter += 1
+                row_ptr = 0
         os.remove(file)
 
+    write_pool.shutdown(wait=True)
+    # Re-raise any error from the write pool
+    for future in writes:
+        future.result()
+
 if __name__ == "__main__":
     ds = datasets.load_dataset("allenai/c4", "en", split="train", token="...")
-    tokenizer = GPT2Tokenizer.from_pretrained("EleutherAI/gpt-neo-1.3B", use_fast=True)
+    tokenizer = GPT2TokenizerFast.from_pretrained("EleutherAI/gpt-neo-1.3B")
     tokenizer.pad_token = tokenizer.eos_token
+    # Looked up once here instead of in every map_to_batch call
+    SPLIT_TOKEN_ID = tokenizer.encode(".")[0]
+    EOS_ID = tokenizer.eos_token_id
     ds.map(map_to_batch, batched=True, batch_size=int(SLICE_SIZE * 1.75), with_indices=True, num_proc=50) 
     process_rest([f"{data_path}/{f}" for f in os.listdir(data_path) if "rest" in f])
\ No newline at end of file
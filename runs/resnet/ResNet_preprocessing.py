@@ -1,110 +1,254 @@
 import datasets
 import torch
 import numpy as np
-from safetensors.torch import save
-from snappy import compress
+from safetensors.torch import save_file
+import zstandard
+import threading
+import math
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+from turbojpeg import TurboJPEG, TJPF_RGB
 from tqdm import tqdm
-#Pillow
+#PyTurboJPEG (libjpeg-turbo), opencv-python
+
+# Format: (Width, Height) because cv2 uses (W, H)
+MAX_SIZE = (256, 480)
+
+jpeg = TurboJPEG()
+
+ZSTD_LEVEL = 3
+
+# ZstdCompressor objects must not be used from several threads at once, so each thread gets its own.
+# threads=-1 lets zstd split each frame across all cores.
+_compressors = threading.local()
+
+def compress_file(path):
+    """Streams a finished shard through zstd into path + ".zst" and removes the uncompressed file."""
+    cctx = getattr(_compressors, "cctx", None)
+    if cctx is None:
+        cctx = _compressors.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+    with open(path, "rb") as src, open(path + ".zst", "wb") as dst:
+        cctx.copy_stream(src, dst, size=os.path.getsize(path))
+        drop_page_cache(dst)
+    os.remove(path)
+
+def drop_page_cache(f):
+    """Tells the kernel a finished shard won't be read back, so it doesn't crowd the dataset out of the page cache.
+
+    DONTNEED only drops clean pages, so the shard is synced to disk first.
+    """
+    f.flush()
+    os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+# --- HELPER: DECODE IN WORKER ---
+def pick_scaling_factor(width, height, target_w, target_h):
+    """Largest libjpeg-turbo IDCT downscale that still yields at least the target size."""
+    best = (1, 1)
+    for num, denom in jpeg.scaling_factors:
+        if num / denom >= best[0] / best[1]:
+            continue
+        if math.ceil(width * num / denom) >= target_w and math.ceil(height * num / denom) >= target_h:
+            best = (num, denom)
+    return best
+
+def decode_fallback(image_bytes):
+    """Decodes the handful of ImageNet files (PNG, CMYK JPEG) libjpeg-turbo can't hand back as RGB."""
+    img_arr = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img_arr, cv2.COLOR_BGR2RGB)
+
+def decode_one(image_bytes, label):
+    """Decodes and clamps a single JPEG to MAX_SIZE. Runs inside a worker process.
+
+    Returns (uint8_array, label, key) or None if the image is too small.
+    """
+    # 1. Read the dimensions from the JPEG header without decoding
+    img_arr = None
+    try:
+        w_curr, h_curr, _, _ = jpeg.decode_header(image_bytes)
+    except OSError:
+        img_arr = decode_fallback(image_bytes)
+        h_curr, w_curr = img_arr.shape[:2]
+
+    # 2. Resize Logic
+    if w_curr < 224 or h_curr < 244:
+        return None
+
+    # Clamp dimensions to MAX_SIZE
+    target_w = min(w_curr, MAX_SIZE[0])
+    target_h = min(h_curr, MAX_SIZE[1])
+
+    # Decode straight to RGB, letting the IDCT do as much of the downscale as it can
+    if img_arr is None:
+        try:
+            scaling_factor = pick_scaling_factor(w_curr, h_curr, target_w, target_h)
+            img_arr = jpeg.decode(image_bytes, pixel_format=TJPF_RGB, scaling_factor=scaling_factor)
+        except OSError:
+            img_arr = decode_fallback(image_bytes)
+
+    # Finish with an area resize if the scaled decode didn't land on the target exactly
+    if img_arr.shape[:2] != (target_h, target_w):
+        img_arr = cv2.resize(img_arr, (target_w, target_h), interpolation=cv2.INTER_AREA)
+
+    return img_arr, label, (target_w, target_h)
+
+def decode_resize(batch):
+    """Decodes and resizes one column batch of raw samples, dropping the too-small ones.
+
+    Runs inside a worker process.
+    """
+    out_imgs = []
+    out_lbls = []
+    out_keys = []
+    for image, label in zip(batch['image'], batch['label']):
+        result = decode_one(image['bytes'], label)
+        if result is None:
+            continue
+        img_arr, label, key = result
+        # Hand back (3, H, W) so the shard buffer is filled in NCHW order directly
+        out_imgs.append(np.ascontiguousarray(img_arr.transpose(2, 0, 1)))
+        out_lbls.append(label)
+        out_keys.append(key)
+    return {'pixels': out_imgs, 'label': out_lbls, 'key': out_keys}
+
+def decode_stream(executor, batches, max_pending=16):
+    """Order-preserving executor.map of decode_resize over an endless stream of batches.
+
+    executor.map submits the whole iterable up front, which would pull the entire
+    streaming dataset into memory. Here only max_pending batches are in flight.
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(executor.submit(decode_resize, batch))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 def main():
     # --- CONFIGURATION ---
     data_dir = "data/imagenet_streaming_train"
     os.makedirs(data_dir, exist_ok=True)
     
-    # Format: (Width, Height) because PIL uses (W, H)
-    MAX_SIZE = (256, 480) 
     SLICE_SIZE = 1000
+    NUM_WORKERS = os.cpu_count()
+    NUM_WRITERS = 4
+    # Samples per batch pulled from the dataset and decoded by one worker
+    BATCH_SIZE = 256
+    # Compress finished shards to .safetensors.zst in the background, False keeps plain .safetensors
+    COMPRESS = True
     
     # State Management
-    # buffers = { (w, h): {'images': [img1, ...], 'labels': [0, ...]} }
+    # buffers = { (w, h): {'images': uint8 (SLICE_SIZE, 3, h, w), 'labels': int64 (SLICE_SIZE,), 'pos': 0} }
     buffers = {}
     # slice_counts = { (w, h): current_file_index }
     slice_counts = {}
     
+    def new_buffer(w, h):
+        """Preallocated shard buffer for resolution (w,h), filled in place up to 'pos'.
+
+        np.empty only commits pages once they are written, so the many rarely used
+        resolutions don't cost a full slice of memory each.
+        """
+        return {
+            'images': np.empty((SLICE_SIZE, 3, h, w), dtype=np.uint8),
+            'labels': np.empty(SLICE_SIZE, dtype=np.int64),
+            'pos': 0,
+        }
+
     # --- HELPER: FLUSH TO DISK ---
+    def write_shard(imgs, lbls, filename):
+        """Serializes and writes one shard. Runs on the write pool."""
+        # 1. Convert
+        # The buffer is already (N, 3, H, W), from_numpy is zero-copy
+        # converting to uint8 saves massive space/time
+        batch_tensor = torch.from_numpy(imgs)
+        label_tensor = torch.from_numpy(lbls)
+        
+        # 2. Save
+        # save_file writes header and tensors straight to the file, no serialized copy in RAM
+        save_file({"images": batch_tensor, "labels": label_tensor}, filename)
+        if COMPRESS:
+            # The compressor reads the shard right back, so its pages stay cached until then
+            writes.append(compress_pool.submit(compress_file, filename))
+        else:
+            with open(filename, "rb") as f:
+                drop_page_cache(f)
+
+    # Serialization and the write run on a thread pool so the ingest loop keeps going.
+    # The semaphore caps how many shards are held in memory at once. Compression is a
+    # separate stage that reads the closed file back, so it never holds a shard in RAM.
+    write_pool = ThreadPoolExecutor(max_workers=NUM_WRITERS)
+    compress_pool = ThreadPoolExecutor(max_workers=1)
+    write_slots = threading.BoundedSemaphore(NUM_WRITERS)
+    writes = []
+
     def flush_buffer(w, h):
-        """Writes the current buffer for resolution (w,h) to disk and clears it."""
-        imgs = buffers[(w, h)]['images']
-        lbls = buffers[(w, h)]['labels']
+        """Hands the current buffer for resolution (w,h) to the write pool and clears it."""
+        buf = buffers[(w, h)]
+        n = buf['pos']
         
-        if not imgs:
+        if n == 0:
             return
-    
-        # 1. Stack and Convert
-        # List of (H, W, 3) -> Tensor (N, 3, H, W)
-        # converting to uint8 saves massive space/time
-        batch_tensor = torch.from_numpy(np.stack(imgs)).permute(0, 3, 1, 2).contiguous()
-        label_tensor = torch.tensor(lbls, dtype=torch.int64)
         
-        # 2. Determine Filename
+        # 1. Determine Filename
         # User requested: train_{h}_{w}_{slice_count}
         idx = slice_counts.get((w, h), 0)
-        filename = os.path.join(data_dir, f"train_{h}_{w}_{idx}_safetensor.snappy")
+        filename = os.path.join(data_dir, f"train_{h}_{w}_{idx}.safetensors")
         
-        # 3. Save
-        # If you need snappy output, use this instead:
-        with open(filename, "wb") as f:
-            f.write(compress(save({"images": batch_tensor, "labels": label_tensor})))
-        
-        # 4. Reset
-        buffers[(w, h)]['images'] = []
-        buffers[(w, h)]['labels'] = []
+        # 2. Reset
+        # The submitted write owns buf from here on
+        buffers[(w, h)] = new_buffer(w, h)
         slice_counts[(w, h)] = idx + 1
+
+        # 3. Submit
+        write_slots.acquire()
+        future = write_pool.submit(write_shard, buf['images'][:n], buf['labels'][:n], filename)
+        future.add_done_callback(lambda _: write_slots.release())
+        writes.append(future)
         
         # Optional: Print only every few saves to avoid clutter
-        # print(f"Saved {filename} ({len(imgs)} items)")
+        # print(f"Saved {filename} ({n} items)")
     
     # --- MAIN LOOP ---
     # streaming=True ensures we process one sample at a time without loading everything
     print("Loading streaming dataset...")
     ds = datasets.load_dataset("ILSVRC/imagenet-1k", split="train", streaming=True)
+    # Keep the raw JPEG bytes, decoding happens in the worker processes
+    ds = ds.cast_column("image", datasets.Image(decode=False))
+    # Column batches keep the per-sample work in the main process down to buffer appends
+    raw_batches = ds.iter(batch_size=BATCH_SIZE)
     
     print("Starting iteration...")
-    for i, sample in tqdm(enumerate(ds), total=1281167): # Total count for ImageNet Train
-        image = sample['image']
-        label = sample['label']
-    
-        # 1. Ensure RGB
-        if image.mode != "RGB":
-            image = image.convert("RGB")
-    
-        # 2. Resize Logic
-        # PIL size is (Width, Height)
-        w_curr, h_curr = image.size
+    with ProcessPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        decoded = decode_stream(executor, raw_batches, max_pending=2 * NUM_WORKERS)
+        for batch in tqdm(decoded, total=math.ceil(1281167 / BATCH_SIZE), unit="batch", mininterval=1.0): # Total count for ImageNet Train
+            for img_arr, label, key in zip(batch['pixels'], batch['label'], batch['key']):
+                # 3. Buffer Management
+                if key not in buffers:
+                    buffers[key] = new_buffer(*key)
 
-        if w_curr < 224 or h_curr < 244:
-            continue
-        
-        # Clamp dimensions to MAX_SIZE
-        target_w = min(w_curr, MAX_SIZE[0])
-        target_h = min(h_curr, MAX_SIZE[1])
-        
-        # Perform resize if dimensions changed
-        if (target_w, target_h) != (w_curr, h_curr):
-            image = image.resize((target_w, target_h))
-        
-        # 3. Buffer Management
-        key = (target_w, target_h)
-        
-        if key not in buffers:
-            buffers[key] = {'images': [], 'labels': []}
-            
-        # Convert to numpy uint8 immediately to save RAM (PIL objects are heavy)
-        img_arr = np.array(image, dtype=np.uint8)
-        
-        buffers[key]['images'].append(img_arr)
-        buffers[key]['labels'].append(label)
-        
-        # 4. Check Capacity
-        if len(buffers[key]['images']) >= SLICE_SIZE:
-            flush_buffer(target_w, target_h)
+                buf = buffers[key]
+                buf['images'][buf['pos']] = img_arr
+                buf['labels'][buf['pos']] = label
+                buf['pos'] += 1
+
+                # 4. Check Capacity
+                if buf['pos'] >= SLICE_SIZE:
+                    flush_buffer(*key)
     
     # --- FINAL CLEANUP ---
     print("Flushing remaining buffers...")
     # Iterate over a copy of keys because we might modify buffers (though flush doesn't delete keys)
     for (w, h) in list(buffers.keys()):
         flush_buffer(w, h)
+    write_pool.shutdown(wait=True)
+    compress_pool.shutdown(wait=True)
+    # Re-raise any error from the write and compress pools
+    for future in writes:
+        future.result()
     
     print("Done.")
     
@@ -1,16 +1,45 @@
+import bisect
 import torch
 import datasets
 import numpy as np
 from transformers import Wav2Vec2Model, AutoFeatureExtractor, AutoConfig, Wav2Vec2ForPreTraining, Wav2Vec2Processor, Wav2Vec2ForCTC
 from safetensors.torch import save
 import os
-import snappy
+import zstandard
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
 
-def snappy_safetensor(tensor_dict, file_path:str):
+ZSTD_LEVEL = 3
+# Samples per shard, a bin is written out as soon as it holds this many
+SAMPLES_PER_FILE = 100
+
+# ZstdCompressor objects must not be used from several threads at once, so each thread gets its own.
+# threads=-1 lets zstd split each frame across all cores.
+_compressors = threading.local()
+
+def zstd_compress(data):
+    """Zstd-compresses data with this thread's compressor."""
+    cctx = getattr(_compressors, "cctx", None)
+    if cctx is None:
+        cctx = _compressors.cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+    return cctx.compress(data)
+
+def zstd_safetensor(tensor_dict, file_path:str):
     # I/O Compression
     tensor_data = save(tensor_dict)
     with open(file_path, 'wb') as out_file:
-        out_file.write(snappy.compress(tensor_data))
+        out_file.write(zstd_compress(tensor_data))
+        drop_page_cache(out_file)
+
+def drop_page_cache(f):
+    """Tells the kernel a finished shard won't be read back, so it doesn't crowd the dataset out of the page cache.
+
+    DONTNEED only drops clean pages, so the shard is synced to disk first.
+    """
+    f.flush()
+    os.fdatasync(f.fileno())
+    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
 
 def estimate_cutoffs():
@@ -18,7 +47,7 @@ def estimate_cutoffs():
     ds = ds.remove_columns(["file", "speaker_id", "chapter_id", "id"])
     audio_legnths = []
 
-    for i, sample in tqdm(enumerate(ds), total=28539): # Total count for ImageNet Train
+    for i, sample in enumerate(tqdm(ds, total=28539, miniters=1000, mininterval=1.0)): # Total count for ImageNet Train
         audio_legnths.append(sample["audio"]["array"].shape[0])
 
     filtered = np.array([i for i in audio_legnths if 4000 < i < 320000])
@@ -33,14 +62,21 @@ def main():
     ds = ds.remove_columns(["file", "speaker_id", "chapter_id", "id"])
     
     data_path = "data/librispeech_100_test/"
-    bin_cut_offs = np.array([ 72320, 134528, 166528, 181888, 192128, 200448, 207360, 214144, 221184, 243968, 320000])
+    # Plain list so the per-sample bin lookup is a bisect instead of a numpy compare + argmax
+    bin_cut_offs = [72320, 134528, 166528, 181888, 192128, 200448, 207360, 214144, 221184, 243968, 320000]
     buffer = [[] for i in range(11)]
     counter = [0 for i in range(11)]
-    samples_per_file = 100
-    for i, sample in tqdm(enumerate(ds), total=28539): # Total count for 100h Train
+    # Serialization, compression and the write run in the background while the stream keeps going.
+    # The semaphore caps how many padded bins are held in memory at once
+    NUM_WRITERS = 2
+    write_pool = ThreadPoolExecutor(max_workers=NUM_WRITERS)
+    write_slots = threading.BoundedSemaphore(NUM_WRITERS)
+    writes = []
+    for i, sample in enumerate(tqdm(ds, total=28539, miniters=1000, mininterval=1.0)): # Total count for 100h Train
         audio_array = sample["audio"]["array"]
         if 4000 < audio_array.shape[0] < 320000:
-            bin_idx = np.argmax(audio_array.shape[0] <= bin_cut_offs) 
+            # First bin whose cut-off is >= the sample length
+            bin_idx = bisect.bisect_left(bin_cut_offs, audio_array.shape[0])
             
             input_len = audio_array.shape[0] // 320
             label_len = len(processor.tokenizer(sample["text"], add_special_tokens=False)["input_ids"])
@@ -48,24 +84,26 @@ def main():
                 print(f"Skipped impossible alignment: {input_len} frames vs {label_len} tokens")
                 continue
         
-            processed_inputs = processor(
-                audio=audio_array, 
-                padding='max_length',
-                max_length=bin_cut_offs[bin_idx],
-                sampling_rate=16000, 
-                truncation=True,
-                return_attention_mask=True,
-                return_tensors="pt"
-            )
-        
-            # Store input_values AND the audio attention_mask
+            # Store the raw audio, feature extraction runs once per full bin
             buffer[bin_idx].append({
-                "input_values": processed_inputs.input_values, 
-                "attention_mask": processed_inputs.attention_mask, # Save Audio Mask
+                "audio": audio_array,
                 "text": sample["text"]
             })
         
-            if len(buffer[bin_idx]) == samples_per_file:
+            if len(buffer[bin_idx]) == SAMPLES_PER_FILE:
+                # Extract features for the whole bin in one batched call.
+                # Ask for numpy and wrap it with from_numpy: return_tensors="pt" would copy the
+                # padded (SAMPLES_PER_FILE, max_length) batch into a second buffer
+                processed_inputs = processor(
+                    audio=[b["audio"] for b in buffer[bin_idx]], 
+                    padding='max_length',
+                    max_length=bin_cut_offs[bin_idx],
+                    sampling_rate=16000, 
+                    truncation=True,
+                    return_attention_mask=True,
+                    return_tensors="np"
+                )
+
                 # Tokenize the text labels
                 tokenized = processor.tokenizer(
                     [b["text"] for b in buffer[bin_idx]],
@@ -76,23 +114,33 @@ def main():
                 labels = tokenized.input_ids
                 # Replace the pad_token_id (usually 0) with -100 so CTC loss ignores them
                 labels[labels == processor.tokenizer.pad_token_id] = -100
+
+                # The raw audio is no longer needed, drop it before serializing
+                buffer[bin_idx] = []
                 
-                snappy_safetensor(
+                write_slots.acquire()
+                future = write_pool.submit(
+                    zstd_safetensor,
                     {
-                        # Concat the audio inputs
-                        "input_values": torch.concat([b["input_values"] for b in buffer[bin_idx]]),
+                        # The audio inputs, already batched
+                        "input_values": torch.from_numpy(processed_inputs.input_values),
                         
-                        # Concat the AUDIO attention masks (Not the text ones!)
-                        "attention_mask": torch.concat([b["attention_mask"] for b in buffer[bin_idx]]),
+                        # The AUDIO attention masks (Not the text ones!)
+                        "attention_mask": torch.from_numpy(processed_inputs.attention_mask),
                         
                         # Use the masked labels
                         "labels": labels
-                    }
-                    f"{data_path}train_{bin_cut_offs[bin_idx]}_{counter[bin_idx]}.saftensor.snappy"
+                    },
+                    os.path.join(data_path, f"train_{bin_cut_offs[bin_idx]}_{counter[bin_idx]}.safetensor.zst")
                 )
-                buffer[bin_idx] = []
+                future.add_done_callback(lambda _: write_slots.release())
+                writes.append(future)
                 counter[bin_idx] += 1
-                break
+
+    write_pool.shutdown(wait=True)
+    # Re-raise any error from the write pool
+    for future in writes:
+        future.result()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -5,21 +5,53 @@ Normalize Grafana-exported Hypha metrics CSVs for Typst plotting.
 Given a base directory that contains run subdirectories (e.g. runs/faults/r600...),
 this script extracts loss, round duration, log levels, RTT, and traffic metrics,
 converts times to hours since the start of each run, normalizes units, and writes
-combined CSVs under the output directory.
+one CSV per run and metric under the output directory (--combine writes one CSV per
+metric covering all runs).
 
 Usage:
     python report/tools/clean_metrics.py --source runs/faults --output report/clean/faults
 """
 
 import argparse
+import logging
 import math
-import os
+import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from turtle import Pen
-from typing import Dict, Iterable, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    CSV_ENGINE = {"engine": "pyarrow"}
+except ImportError:
+    pa = pacsv = None
+    CSV_ENGINE = {}
+
+CSV_WRITE_OPTIONS = None
+if pacsv is not None:
+    try:
+        # Unquoted header as DataFrame.to_csv writes it, pyarrow still quotes string values
+        CSV_WRITE_OPTIONS = pacsv.WriteOptions(quoting_style="needed", quoting_header="none")
+    except TypeError:
+        # quoting_header is new in pyarrow 22, older versions write CSVs with to_csv
+        pass
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+log = logging.getLogger(__name__)
+
+# Rows per chunk for the exports that are streamed instead of read whole
+CSV_CHUNK_ROWS = 100_000
+
 LOSS_PREFIX = "Loss-data"
 ROUND_PREFIX = "Round Duration"
 LOG_PREFIXES = (
@@ -39,6 +71,71 @@ SLICE_REDIRECT_PREFIX = "Slice Redirect_h-data"
 ROUNDS_PREFIX = "Rounds_h-data"
 EVAL_RETURN_PREFIX = "Evaluation Return-data"
 
+ALL_PREFIXES = (
+    LOSS_PREFIX,
+    ROUND_PREFIX,
+    *LOG_PREFIXES,
+    RTT_PREFIX,
+    RTT_JOIN_PREFIX,
+    TRAFFIC_PREFIX,
+    TRAFFIC_BY_SERVICE_PREFIX,
+    SPEED_PREFIX,
+    SLICE_REDIRECT_PREFIX,
+    ROUNDS_PREFIX,
+    EVAL_RETURN_PREFIX,
+)
+
+# Substrings of by-service column names that belong to non-worker services
+NON_WORKER_KEYWORDS = frozenset({"gateway", "scheduler"})
+
+
+# Column filters for read_csv(columns=...) on layouts where clean_run only ever looks at
+# a known subset of the columns, so the rest are never parsed
+def value_columns(col: str) -> bool:
+    return col in ("Time", "Value")
+
+
+def log_columns(col: str) -> bool:
+    return col == "Time" or col.lower() in ("error", "warn")
+
+
+def traffic_columns(col: str) -> bool:
+    return col == "Time" or col.startswith(("in:", "out:", "sum:"))
+
+
+def read_csv(path: Path, columns=None) -> pd.DataFrame:
+    """Reads a Grafana export, with the multi-threaded pyarrow parser when it is installed.
+
+    columns is an optional filter on column names. The header is read separately with
+    the C parser: the pyarrow engine only takes usecols as a list of names, and it does
+    not rename duplicate worker columns ("x", "x.1") the way the C parser does.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    if columns is not None:
+        return pd.read_csv(path, usecols=[c for c in header if columns(c)], **CSV_ENGINE)
+    df = pd.read_csv(path, **CSV_ENGINE)
+    df.columns = header
+    return df
+
+
+def read_csv_chunks(path: Path, columns) -> Iterable[pd.DataFrame]:
+    """Reads a large Grafana export in CSV_CHUNK_ROWS row chunks.
+
+    Uses the C parser, the pyarrow engine can't read in chunks.
+    """
+    return pd.read_csv(path, usecols=columns, chunksize=CSV_CHUNK_ROWS)
+
+
+def write_output(df: pd.DataFrame, path: Path) -> None:
+    """Writes a cleaned frame as CSV, or as Parquet when path ends in .parquet."""
+    if path.suffix == ".parquet":
+        df.to_parquet(path, index=False)
+    elif CSV_WRITE_OPTIONS is not None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        pacsv.write_csv(table, str(path), CSV_WRITE_OPTIONS)
+    else:
+        df.to_csv(path, index=False)
+
 
 def parse_args() -> argparse.Namespace:
     ap = argparse.ArgumentParser(description=__doc__)
@@ -51,153 +148,323 @@ def parse_args() -> argparse.Namespace:
         default="r6*",
         help="Glob for selecting run subdirectories (default: r6*)",
     )
+    ap.add_argument(
+        "--format",
+        choices=("csv", "parquet"),
+        default="csv",
+        help="Output file format (default: csv)",
+    )
+    ap.add_argument(
+        "--combine",
+        action="store_true",
+        help="Write one file per metric with all runs instead of one per run and metric",
+    )
+    ap.add_argument(
+        "--verbose", action="store_true", help="Log every file lookup and write"
+    )
     return ap.parse_args()
 
 
-def parse_duration_s(val) -> Optional[float]:
-    if val is None or (isinstance(val, float) and math.isnan(val)):
-        return None
-    txt = str(val).strip()
-    if not txt:
-        return None
-    if txt.endswith(" ms"):
-        return float(txt[:-3].strip()) / 1000.0
-    if txt.endswith(" s"):
-        return float(txt[:-2].strip())
-    if txt.endswith(" mins"):
-        return float(txt[:-5].strip()) * 60.0
-    if txt.endswith(" min"):
-        return float(txt[:-4].strip()) * 60.0
-    if txt.endswith(" h"):
-        return float(txt[:-2].strip()) * 3600.0
+# Metric cells look like "<number> <unit>". Each parser is a precompiled regex plus a table
+# mapping the unit to a (multiplier, divisor) pair, keeping multiplication and division
+# apart reproduces the original if/elif parsers bit for bit.
+NUMBER_RE = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+
+DURATION_S_RE = re.compile(rf"^({NUMBER_RE})(?: +(ms|s|mins|min|h))?$")
+DURATION_S_SCALES = {
+    "": (1.0, 1.0),
+    "ms": (1.0, 1000.0),
+    "s": (1.0, 1.0),
+    "mins": (60.0, 1.0),
+    "min": (60.0, 1.0),
+    "h": (3600.0, 1.0),
+}
+
+COUNT_RE = re.compile(rf"^({NUMBER_RE}) *([KM]?)$")
+COUNT_SCALES = {
+    "": (1.0, 1.0),
+    "K": (1000.0, 1.0),
+    "M": (1_000_000.0, 1.0),
+}
+
+MS_RE = re.compile(rf"^({NUMBER_RE})(?: +(ms|s))?$")
+MS_SCALES = {
+    "": (1.0, 1.0),
+    "ms": (1.0, 1.0),
+    "s": (1000.0, 1.0),
+}
+
+SPEED_MBPS_RE = re.compile(rf"^({NUMBER_RE})(?: +(Gb/s|Mb/s|kb/s|b/s))?$")
+SPEED_MBPS_SCALES = {
+    "": (1.0, 1.0),
+    "Gb/s": (1000.0, 1.0),
+    "Mb/s": (1.0, 1.0),
+    "kb/s": (1.0, 1000.0),
+    "b/s": (1.0, 1_000_000.0),
+}
+
+# Handles both "1.5 GB" and "1.5GB", case-insensitive
+SIZE_MB_RE = re.compile(rf"^({NUMBER_RE}) *(tb|gb|mb|kb|b)?$", re.IGNORECASE)
+SIZE_MB_SCALES = {
+    "": (1.0, 1.0),
+    "tb": (1024.0 * 1024.0, 1.0),
+    "gb": (1024.0, 1.0),
+    "mb": (1.0, 1.0),
+    "kb": (1.0, 1024.0),
+    "b": (1.0, 1024.0 * 1024.0),
+}
+
+
+def is_missing(val) -> bool:
+    return val is None or (isinstance(val, float) and math.isnan(val))
+
+
+def parse_units(txt: str, pattern: re.Pattern, scales: Dict[str, Tuple[float, float]]) -> Optional[float]:
+    m = pattern.match(txt)
+    if m:
+        unit = m.group(2) or ""
+        if pattern.flags & re.IGNORECASE:
+            unit = unit.lower()
+        mult, div = scales[unit]
+        return float(m.group(1)) * mult / div
     try:
         return float(txt)
     except ValueError:
         return None
 
 
+def parse_duration_s(val) -> Optional[float]:
+    if is_missing(val):
+        return None
+    return parse_units(str(val).strip(), DURATION_S_RE, DURATION_S_SCALES)
+
+
 def parse_count(val) -> float:
-    if val is None or (isinstance(val, float) and math.isnan(val)):
-        return 0.0
-    txt = str(val).strip()
-    if not txt:
-        return 0.0
-    if txt.endswith("K"):
-        return float(txt[:-1].strip()) * 1000.0
-    if txt.endswith("M"):
-        return float(txt[:-1].strip()) * 1_000_000.0
-    try:
-        return float(txt)
-    except ValueError:
+    if is_missing(val):
         return 0.0
+    parsed = parse_units(str(val).strip(), COUNT_RE, COUNT_SCALES)
+    return 0.0 if parsed is None else parsed
 
 
 def parse_ms(val) -> Optional[float]:
-    if val is None or (isinstance(val, float) and math.isnan(val)):
-        return None
-    txt = str(val).strip()
-    if not txt:
-        return None
-    if txt.endswith(" ms"):
-        return float(txt[:-3].strip())
-    if txt.endswith(" s"):
-        return float(txt[:-2].strip()) * 1000.0
-    try:
-        return float(txt)
-    except ValueError:
+    if is_missing(val):
         return None
+    return parse_units(str(val).strip(), MS_RE, MS_SCALES)
 
 
 def parse_speed_mbps(val) -> Optional[float]:
     """Parse speed values like '199 Mb/s', '4.76 kb/s' to Mb/s."""
-    if val is None or (isinstance(val, float) and math.isnan(val)):
-        return None
-    txt = str(val).strip()
-    if not txt:
-        return None
-    if txt.endswith(" Gb/s"):
-        return float(txt[:-5].strip()) * 1000.0
-    if txt.endswith(" Mb/s"):
-        return float(txt[:-5].strip())
-    if txt.endswith(" kb/s"):
-        return float(txt[:-5].strip()) / 1000.0
-    if txt.endswith(" b/s"):
-        return float(txt[:-4].strip()) / 1_000_000.0
-    try:
-        return float(txt)
-    except ValueError:
+    if is_missing(val):
         return None
+    return parse_units(str(val).strip(), SPEED_MBPS_RE, SPEED_MBPS_SCALES)
 
 
 def parse_size_mb(val) -> Optional[float]:
-    if val is None or (isinstance(val, float) and math.isnan(val)):
-        return None
-    txt = str(val).strip().replace(",", "")
-    if not txt:
-        return None
-    # Normalize: handle both "1.5 GB" and "1.5GB" formats, case-insensitive
-    txt_lower = txt.lower()
-    if txt_lower.endswith("tb"):
-        return float(txt[:-2].strip()) * 1024.0 * 1024.0
-    if txt_lower.endswith("gb"):
-        return float(txt[:-2].strip()) * 1024.0
-    if txt_lower.endswith("mb"):
-        return float(txt[:-2].strip())
-    if txt_lower.endswith("kb"):
-        return float(txt[:-2].strip()) / 1024.0
-    if txt_lower.endswith("b"):
-        return float(txt[:-1].strip()) / (1024.0 * 1024.0)
-    try:
-        return float(txt)
-    except ValueError:
+    if is_missing(val):
         return None
+    return parse_units(str(val).strip().replace(",", ""), SIZE_MB_RE, SIZE_MB_SCALES)
+
+
+# Column versions of the parse_* helpers above: matching cells are converted in one
+# vectorized pass, anything else falls back to the scalar helper.
+def parse_series(
+    values: pd.Series,
+    pattern: re.Pattern,
+    scales: Dict[str, Tuple[float, float]],
+    fallback,
+    strip_commas: bool = False,
+) -> pd.Series:
+    txt = values.astype(str).str.strip()
+    if strip_commas:
+        txt = txt.str.replace(",", "", regex=False)
+    parts = txt.str.extract(pattern)
+    units = parts[1].fillna("")
+    if pattern.flags & re.IGNORECASE:
+        units = units.str.lower()
+    mult = units.map({u: m for u, (m, _) in scales.items()})
+    div = units.map({u: d for u, (_, d) in scales.items()})
+    result = parts[0].astype(float) * mult / div
+
+    rest = parts[0].isna() & values.notna()
+    if rest.any():
+        result[rest] = values[rest].map(fallback).astype(float)
+    return result
+
+
+def parse_duration_s_series(values: pd.Series) -> pd.Series:
+    return parse_series(values, DURATION_S_RE, DURATION_S_SCALES, parse_duration_s)
+
+
+def parse_count_series(values: pd.Series) -> pd.Series:
+    """Counts only carry an optional K/M suffix, so a dict map on the last character
+    replaces the regex extract."""
+    txt = values.astype(str).str.strip()
+    last = txt.str[-1]
+    suffixed = last.isin(["K", "M"])
+    mult = last.map({u: m for u, (m, _) in COUNT_SCALES.items() if u}).fillna(1.0)
+    body = txt.where(~suffixed, txt.str[:-1].str.rstrip())
+    result = pd.to_numeric(body, errors="coerce") * mult
+
+    rest = result.isna() & values.notna()
+    if rest.any():
+        result[rest] = values[rest].map(parse_count).astype(float)
+    # Missing cells count as 0, like parse_count
+    return result.where(values.notna(), 0.0)
+
+
+def parse_ms_series(values: pd.Series) -> pd.Series:
+    return parse_series(values, MS_RE, MS_SCALES, parse_ms)
+
+
+def parse_speed_mbps_series(values: pd.Series) -> pd.Series:
+    return parse_series(values, SPEED_MBPS_RE, SPEED_MBPS_SCALES, parse_speed_mbps)
+
+
+def parse_size_mb_series(values: pd.Series) -> pd.Series:
+    return parse_series(
+        values, SIZE_MB_RE, SIZE_MB_SCALES, parse_size_mb, strip_commas=True
+    )
 
 
-def find_first(run_dir: Path, prefix: str) -> Optional[Path]:
-    print(f"Searching for prefixes {prefix} in {run_dir}")
+def row_sum(columns: List[pd.Series]) -> pd.Series:
+    """Row-wise sum of parsed worker columns, NaN where a row has no value.
+
+    Columns are added left to right, so the result matches summing each row's values
+    in column order bit for bit.
+    """
+    total = columns[0]
+    for col in columns[1:]:
+        total = total.add(col, fill_value=0.0)
+    return total
+
+
+def sum_size_columns(df: pd.DataFrame, cols: List[str]) -> np.ndarray:
+    """Per-row total in MB over the given size columns, NaN where none of them has a value."""
+    if not cols:
+        return np.full(len(df), np.nan)
+    return row_sum([parse_size_mb_series(df[c]) for c in cols]).to_numpy()
+
+
+def row_mean(columns: List[pd.Series]) -> pd.Series:
+    counts = sum(col.notna().astype(int) for col in columns)
+    return row_sum(columns) / counts
+
+
+def positive_cumsum(values: np.ndarray) -> np.ndarray:
+    """Cumulative sum of the positive steps between consecutive valid values.
+
+    Counter resets and drops (workers restarting or going offline) add nothing, and
+    the first valid value is the zero baseline. NaN inputs stay NaN in the output.
+    """
+    if _positive_cumsum_jit is not None:
+        return _positive_cumsum_jit(values)
+    out = np.full(len(values), np.nan)
+    valid = ~np.isnan(values)
+    deltas = np.diff(values[valid])
+    out[valid] = np.concatenate(([0.0], np.cumsum(np.where(deltas > 0, deltas, 0.0))))
+    return out
+
+
+def _positive_cumsum_loop(values: np.ndarray) -> np.ndarray:
+    # Single pass without the mask, diff and where temporaries, only worth it compiled
+    out = np.empty_like(values)
+    total = 0.0
+    prev = np.nan
+    for i in range(values.size):
+        v = values[i]
+        if np.isnan(v):
+            out[i] = np.nan
+            continue
+        if not np.isnan(prev) and v > prev:
+            total += v - prev
+        prev = v
+        out[i] = total
+    return out
+
+
+_positive_cumsum_jit = njit(cache=True)(_positive_cumsum_loop) if njit is not None else None
+
+
+def index_run_dir(run_dir: Path) -> Dict[str, Path]:
+    """Maps every known metric prefix to the first file (in sorted order) starting with it.
+
+    One directory listing and one pass over it serve all lookups of a run. A file can
+    match several prefixes, e.g. RTT_PREFIX also matches the join-by-field RTT export.
+    """
+    files: Dict[str, Path] = {}
     for p in sorted(run_dir.iterdir()):
-        print(f"Checking file {p}: {prefix}")
-        if p.name.startswith(prefix):
-            return p
-    return None
+        for prefix in ALL_PREFIXES:
+            if prefix not in files and p.name.startswith(prefix):
+                files[prefix] = p
+    log.debug("Found %s in %s", sorted(files), run_dir)
+    return files
 
 
-def find_first_in_list(run_dir: Path, prefixes: Iterable[str]) -> Optional[Path]:
-    print(f"Searching for prefixes {prefixes} in {run_dir}")
+def worker_columns_by_kind(columns: Iterable[str]) -> Dict[str, List[str]]:
+    """Splits by-service traffic columns into worker in/out/sum columns.
+
+    Gateway and scheduler columns are skipped, by substring so "gateway1" goes too.
+    """
+    by_kind: Dict[str, List[str]] = {"in": [], "out": [], "sum": []}
+    for c in columns:
+        kind = c.split(":", 1)[0] if ":" in c else None
+        if kind in by_kind and not any(k in c.lower() for k in NON_WORKER_KEYWORDS):
+            by_kind[kind].append(c)
+    return by_kind
+
+
+def find_first_in_list(files: Dict[str, Path], prefixes: Iterable[str]) -> Optional[Path]:
     for pref in prefixes:
-        p = find_first(run_dir, pref)
-        if p:
-            return p
+        if pref in files:
+            return files[pref]
     return None
 
 
+def run_column(run: str, n: int) -> pd.Categorical:
+    """The constant run column as a one-category Categorical, one byte per row instead of a string."""
+    return pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), categories=[run])
+
+
 def add_time_offset(df: pd.DataFrame, run: str) -> pd.DataFrame:
+    """Returns df sorted by time with t_hours and run columns added.
+
+    The Time column of the passed frame is converted in place; callers hand in a
+    freshly read frame and only use the returned one.
+    """
     if "Time" not in df.columns:
         return pd.DataFrame()
-    df = df.copy()
     # Check if Time column contains epoch milliseconds (large integers)
     first_val = df["Time"].iloc[0]
     # Use pd.api.types to handle numpy integers properly
-    if pd.api.types.is_number(first_val) and first_val > 1e12:
-        # Epoch milliseconds
-        df["Time"] = pd.to_datetime(df["Time"], unit="ms")
+    if pd.api.types.is_integer_dtype(df["Time"]) and first_val > 1e12:
+        # Epoch milliseconds as int64: only t_hours is needed, so skip datetime64 entirely.
+        # Dividing by 1000 then 3600 matches total_seconds() on the ms-resolution datetimes
+        df = df.sort_values("Time")
+        ms = df["Time"].to_numpy()
+        df["t_hours"] = (ms - ms[0]) / 1000 / 3600.0
     else:
-        df["Time"] = pd.to_datetime(df["Time"])
-    df = df.sort_values("Time")
-    t0 = df["Time"].iloc[0]
-    df["t_hours"] = (df["Time"] - t0).dt.total_seconds() / 3600.0
-    df["run"] = run
+        if pd.api.types.is_number(first_val) and first_val > 1e12:
+            # Epoch milliseconds with missing values (float column)
+            df["Time"] = pd.to_datetime(df["Time"], unit="ms")
+        else:
+            # Grafana exports ISO 8601 ("2026-01-29 09:35:14"), naming the format skips per-row inference
+            df["Time"] = pd.to_datetime(df["Time"], format="ISO8601")
+        df = df.sort_values("Time")
+        t0 = df["Time"].iloc[0]
+        df["t_hours"] = (df["Time"] - t0).dt.total_seconds() / 3600.0
+    df["run"] = run_column(run, len(df))
     return df
 
 
 def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
     run = run_dir.name
     out: Dict[str, pd.DataFrame] = {}
+    files = index_run_dir(run_dir)
 
-    loss_file = find_first(run_dir, LOSS_PREFIX)
-    print(f"Processing loss_file {loss_file}")
+    loss_file = files.get(LOSS_PREFIX)
+    log.debug("Processing loss_file %s", loss_file)
     if loss_file:
-        df = pd.read_csv(loss_file)
+        df = read_csv(loss_file)
         df = add_time_offset(df, run)
         if "Weighted Average" in df.columns:
             df = df[["run", "t_hours", "Weighted Average"]].rename(
@@ -215,102 +482,107 @@ def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
                 df = df.dropna(subset=["loss"])
                 out["loss"] = df[["run", "t_hours", "loss"]]
 
-    round_file = find_first(run_dir, ROUND_PREFIX)
-    print(f"Processing round_file {round_file}")
+    round_file = files.get(ROUND_PREFIX)
+    log.debug("Processing round_file %s", round_file)
     if round_file:
-        df = pd.read_csv(round_file)
+        df = read_csv(round_file)
         df = add_time_offset(df, run)
         if df.shape[1] >= 2:
             # Handle join-by-field format: average across worker columns
             cols = [c for c in df.columns if c not in ("Time", "run", "t_hours")]
             if cols:
-                series = []
-                for _, row in df.iterrows():
-                    vals = [parse_duration_s(row[c]) for c in cols if pd.notna(row[c])]
-                    vals = [v for v in vals if v is not None]
-                    if not vals:
-                        continue
-                    series.append(
-                        {
-                            "run": run,
-                            "t_hours": row["t_hours"],
-                            "round_s": sum(vals) / len(vals),
-                        }
-                    )
-                if series:
-                    out["round"] = pd.DataFrame(series)
+                vals = [parse_duration_s_series(df[c]) for c in cols]
+                rdf = pd.DataFrame(
+                    {
+                        "run": run_column(run, len(df)),
+                        "t_hours": df["t_hours"].to_numpy(),
+                        "round_s": row_mean(vals).to_numpy(),
+                    }
+                ).dropna(subset=["round_s"])
+                if len(rdf):
+                    out["round"] = rdf
     else:
         # Compute round duration from Rounds_h (rounds per interval)
-        rounds_file = find_first(run_dir, ROUNDS_PREFIX)
+        rounds_file = files.get(ROUNDS_PREFIX)
         if rounds_file:
-            df = pd.read_csv(rounds_file)
+            df = read_csv(rounds_file, columns=value_columns)
             df = add_time_offset(df, run)
             if "Value" in df.columns and len(df) >= 2:
                 # Compute interval in seconds from timestamps
                 interval_s = (df["t_hours"].iloc[1] - df["t_hours"].iloc[0]) * 3600
-                df["rounds_count"] = df["Value"].apply(parse_count)
+                df["rounds_count"] = parse_count_series(df["Value"])
                 # Round duration = interval / rounds_per_interval
-                df["round_s"] = df["rounds_count"].apply(
-                    lambda r: interval_s / r if r > 0 else None
-                )
+                df["round_s"] = interval_s / df["rounds_count"].where(df["rounds_count"] > 0)
                 df = df.dropna(subset=["round_s"])
                 out["round"] = df[["run", "t_hours", "round_s"]]
 
-    log_file = find_first_in_list(run_dir, LOG_PREFIXES)
-    print(f"Processing log_file {log_file}")
+    log_file = find_first_in_list(files, LOG_PREFIXES)
+    log.debug("Processing log_file %s", log_file)
     if log_file:
-        df = pd.read_csv(log_file)
+        df = read_csv(log_file, columns=log_columns)
         df = add_time_offset(df, run)
         if "error" in df.columns or "warn" in df.columns:
             err_col = next((c for c in df.columns if c.lower() == "error"), None)
             warn_col = next((c for c in df.columns if c.lower() == "warn"), None)
             if err_col or warn_col:
-                df["errors"] = df[err_col].apply(parse_count) if err_col else 0.0
-                df["warns"] = df[warn_col].apply(parse_count) if warn_col else 0.0
+                df["errors"] = parse_count_series(df[err_col]) if err_col else 0.0
+                df["warns"] = parse_count_series(df[warn_col]) if warn_col else 0.0
                 out["logs"] = df[["run", "t_hours", "errors", "warns"]]
 
-    rtt_file = find_first(run_dir, RTT_PREFIX)
-    rtt_join_file = find_first(run_dir, RTT_JOIN_PREFIX)
-    print(f"Processing rtt_file {rtt_file}")
+    rtt_file = files.get(RTT_PREFIX)
+    rtt_join_file = files.get(RTT_JOIN_PREFIX)
+    log.debug("Processing rtt_file %s", rtt_file)
     if rtt_file:
-        df = pd.read_csv(rtt_file)
+        df = read_csv(rtt_file)
         df = add_time_offset(df, run)
         if df.shape[1] >= 2:
             val_col = df.columns[1]
-            df["rtt_ms"] = df[val_col].apply(parse_ms)
+            df["rtt_ms"] = parse_ms_series(df[val_col])
             df = df.dropna(subset=["rtt_ms"])
             out["rtt"] = df[["run", "t_hours", "rtt_ms"]]
     elif rtt_join_file:
-        df = pd.read_csv(rtt_join_file)
+        df = read_csv(rtt_join_file)
         df = add_time_offset(df, run)
-        cols = [c for c in df.columns if c != "Time"]
-        series = []
-        for _, row in df.iterrows():
-            vals = [parse_ms(row[c]) for c in cols if pd.notna(row[c])]
-            vals = [v for v in vals if v is not None]
-            if not vals:
-                continue
-            series.append(
-                {"run": run, "t_hours": row["t_hours"], "rtt_ms": sum(vals) / len(vals)}
-            )
-        if series:
-            out["rtt"] = pd.DataFrame(series)
-
-    traffic_file = find_first(run_dir, TRAFFIC_PREFIX)
-    traffic_by_service_file = find_first(run_dir, TRAFFIC_BY_SERVICE_PREFIX)
-
-    # Use regular traffic file if available, otherwise use by-service file
+        cols = [c for c in df.columns if c not in ("Time", "run", "t_hours")]
+        if cols:
+            vals = [parse_ms_series(df[c]) for c in cols]
+            rdf = pd.DataFrame(
+                {
+                    "run": run_column(run, len(df)),
+                    "t_hours": df["t_hours"].to_numpy(),
+                    "rtt_ms": row_mean(vals).to_numpy(),
+                }
+            ).dropna(subset=["rtt_ms"])
+            if len(rdf):
+                out["rtt"] = rdf
+
+    traffic_file = files.get(TRAFFIC_PREFIX)
+    traffic_by_service_file = files.get(TRAFFIC_BY_SERVICE_PREFIX)
+
+    # Use regular traffic file if available, otherwise use by-service file.
+    # Traffic exports are the widest and longest files. They are parsed chunk by chunk
+    # down to numeric columns, only sorting and the counter-reset handling need all rows.
     if traffic_file:
-        print(f"Processing traffic_file {traffic_file}")
-        df = pd.read_csv(traffic_file)
-        df = add_time_offset(df, run)
-        in_col = next((c for c in df.columns if c.startswith("in:")), None)
-        out_col = next((c for c in df.columns if c.startswith("out:")), None)
-        sum_col = next((c for c in df.columns if c.startswith("sum:")), None)
-        if in_col or out_col or sum_col:
-            df["in_mb_raw"] = df[in_col].apply(parse_size_mb) if in_col else None
-            df["out_mb_raw"] = df[out_col].apply(parse_size_mb) if out_col else None
-            df["sum_mb_raw"] = df[sum_col].apply(parse_size_mb) if sum_col else None
+        log.debug("Processing traffic_file %s", traffic_file)
+        parts = []
+        for chunk in read_csv_chunks(traffic_file, columns=traffic_columns):
+            in_col = next((c for c in chunk.columns if c.startswith("in:")), None)
+            out_col = next((c for c in chunk.columns if c.startswith("out:")), None)
+            sum_col = next((c for c in chunk.columns if c.startswith("sum:")), None)
+            if "Time" not in chunk.columns or not (in_col or out_col or sum_col):
+                break
+            parts.append(
+                pd.DataFrame(
+                    {
+                        "Time": chunk["Time"],
+                        "in_mb_raw": parse_size_mb_series(chunk[in_col]) if in_col else None,
+                        "out_mb_raw": parse_size_mb_series(chunk[out_col]) if out_col else None,
+                        "sum_mb_raw": parse_size_mb_series(chunk[sum_col]) if sum_col else None,
+                    }
+                )
+            )
+        if parts:
+            df = add_time_offset(pd.concat(parts, ignore_index=True), run)
 
             # Handle counter resets/drops: accumulate only positive deltas
             # When workers restart or go offline, we only count forward progress
@@ -321,26 +593,7 @@ def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
                 ("sum_mb_raw", "sum_mb"),
             ]:
                 if col_raw in df.columns and df[col_raw].notna().any():
-                    values = df[col_raw].values
-                    cumulative = []
-                    total = 0.0
-                    prev_val = None
-                    baseline = None
-                    for val in values:
-                        if pd.isna(val):
-                            cumulative.append(None)
-                            continue
-                        if baseline is None:
-                            # First valid value becomes baseline - subtract it to start from zero
-                            baseline = val
-                        if prev_val is not None:
-                            delta = val - prev_val
-                            if delta > 0:
-                                total += delta
-                        # First value after baseline: total stays 0
-                        cumulative.append(total)
-                        prev_val = val
-                    df[col_out] = cumulative
+                    df[col_out] = positive_cumsum(df[col_raw].to_numpy(dtype=float))
                 else:
                     df[col_out] = None
 
@@ -348,52 +601,34 @@ def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
             out["traffic"] = df[["run", "t_hours", "in_mb", "out_mb", "sum_mb"]]
     elif traffic_by_service_file:
         # Handle "by Service" format - sum across worker columns
-        df = pd.read_csv(traffic_by_service_file)
-        df = add_time_offset(df, run)
-        # Find in/out/sum columns for workers (exclude gateway, scheduler)
-        in_cols = [
-            c
-            for c in df.columns
-            if c.startswith("in:")
-            and "gateway" not in c.lower()
-            and "scheduler" not in c.lower()
-        ]
-        out_cols = [
-            c
-            for c in df.columns
-            if c.startswith("out:")
-            and "gateway" not in c.lower()
-            and "scheduler" not in c.lower()
-        ]
-        sum_cols = [
-            c
-            for c in df.columns
-            if c.startswith("sum:")
-            and "gateway" not in c.lower()
-            and "scheduler" not in c.lower()
-        ]
-        if sum_cols:
-            series = []
-            for _, row in df.iterrows():
-                in_vals = [parse_size_mb(row[c]) for c in in_cols if pd.notna(row[c])]
-                in_vals = [v for v in in_vals if v is not None]
-                out_vals = [parse_size_mb(row[c]) for c in out_cols if pd.notna(row[c])]
-                out_vals = [v for v in out_vals if v is not None]
-                sum_vals = [parse_size_mb(row[c]) for c in sum_cols if pd.notna(row[c])]
-                sum_vals = [v for v in sum_vals if v is not None]
-                if not sum_vals:
-                    continue
-                series.append(
+        parts = []
+        cols_by_kind = None
+        for chunk in read_csv_chunks(traffic_by_service_file, columns=traffic_columns):
+            # Every chunk has the same header, classify the worker columns once
+            if cols_by_kind is None:
+                cols_by_kind = worker_columns_by_kind(chunk.columns)
+            if "Time" not in chunk.columns or not cols_by_kind["sum"]:
+                break
+            parts.append(
+                pd.DataFrame(
                     {
-                        "run": run,
-                        "t_hours": row["t_hours"],
-                        "in_mb_raw": sum(in_vals) if in_vals else None,
-                        "out_mb_raw": sum(out_vals) if out_vals else None,
-                        "sum_mb_raw": sum(sum_vals),
+                        "Time": chunk["Time"],
+                        "in_mb_raw": sum_size_columns(chunk, cols_by_kind["in"]),
+                        "out_mb_raw": sum_size_columns(chunk, cols_by_kind["out"]),
+                        "sum_mb_raw": sum_size_columns(chunk, cols_by_kind["sum"]),
                     }
                 )
-            if series:
-                tdf = pd.DataFrame(series)
+            )
+        if parts:
+            df = add_time_offset(pd.concat(parts, ignore_index=True), run)
+            keep = df["sum_mb_raw"].notna().to_numpy()
+            if keep.any():
+                # Build the output column by column from the kept rows instead of
+                # assigning onto a sliced copy of the frame
+                tdf = {
+                    "run": run_column(run, int(keep.sum())),
+                    "t_hours": df["t_hours"].to_numpy()[keep],
+                }
                 # Apply counter reset handling for each metric
                 # Always start from zero (subtract initial baseline for hot workers)
                 for col_raw, col_out in [
@@ -401,35 +636,14 @@ def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
                     ("out_mb_raw", "out_mb"),
                     ("sum_mb_raw", "sum_mb"),
                 ]:
-                    if col_raw in tdf.columns and tdf[col_raw].notna().any():
-                        values = tdf[col_raw].values
-                        cumulative = []
-                        total = 0.0
-                        prev_val = None
-                        baseline = None
-                        for val in values:
-                            if pd.isna(val):
-                                cumulative.append(None)
-                                continue
-                            if baseline is None:
-                                # First valid value becomes baseline - subtract it to start from zero
-                                baseline = val
-                            if prev_val is not None:
-                                delta = val - prev_val
-                                if delta > 0:
-                                    total += delta
-                            # First value after baseline: total stays 0
-                            cumulative.append(total)
-                            prev_val = val
-                        tdf[col_out] = cumulative
-                    else:
-                        tdf[col_out] = None
-                out["traffic"] = tdf[["run", "t_hours", "in_mb", "out_mb", "sum_mb"]]
+                    raw = df[col_raw].to_numpy(dtype=float)[keep]
+                    tdf[col_out] = positive_cumsum(raw) if not np.isnan(raw).all() else None
+                out["traffic"] = pd.DataFrame(tdf)
 
     # Network speed (by service) - sum across workers
-    speed_file = find_first(run_dir, SPEED_PREFIX)
+    speed_file = files.get(SPEED_PREFIX)
     if speed_file:
-        df = pd.read_csv(speed_file)
+        df = read_csv(speed_file)
         df = add_time_offset(df, run)
         # Exclude non-worker columns (scheduler, gateway)
         worker_cols = [
@@ -438,48 +652,41 @@ def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
             if c not in ("Time", "run", "t_hours", "scheduler", "gateway1", "gateway")
         ]
         if worker_cols:
-            series = []
-            for _, row in df.iterrows():
-                vals = [
-                    parse_speed_mbps(row[c]) for c in worker_cols if pd.notna(row[c])
-                ]
-                vals = [v for v in vals if v is not None]
-                if not vals:
-                    continue
-                series.append(
-                    {
-                        "run": run,
-                        "t_hours": row["t_hours"],
-                        "speed_mbps": sum(vals),
-                    }
-                )
-            if series:
-                out["speed"] = pd.DataFrame(series)
+            vals = [parse_speed_mbps_series(df[c]) for c in worker_cols]
+            sdf = pd.DataFrame(
+                {
+                    "run": run_column(run, len(df)),
+                    "t_hours": df["t_hours"].to_numpy(),
+                    "speed_mbps": row_sum(vals).to_numpy(),
+                }
+            ).dropna(subset=["speed_mbps"])
+            if len(sdf):
+                out["speed"] = sdf
 
     # Slice redirect count (cumulative redirects over time)
-    slice_redirect_file = find_first(run_dir, SLICE_REDIRECT_PREFIX)
+    slice_redirect_file = files.get(SLICE_REDIRECT_PREFIX)
     if slice_redirect_file:
-        df = pd.read_csv(slice_redirect_file)
+        df = read_csv(slice_redirect_file, columns=value_columns)
         df = add_time_offset(df, run)
         if "Value" in df.columns:
-            df["redirects"] = df["Value"].apply(parse_count)
+            df["redirects"] = parse_count_series(df["Value"])
             df = df.dropna(subset=["redirects"])
             out["sliceredirect"] = df[["run", "t_hours", "redirects"]]
 
     # Rounds count (cumulative rounds over time)
-    rounds_file = find_first(run_dir, ROUNDS_PREFIX)
+    rounds_file = files.get(ROUNDS_PREFIX)
     if rounds_file:
-        df = pd.read_csv(rounds_file)
+        df = read_csv(rounds_file, columns=value_columns)
         df = add_time_offset(df, run)
         if "Value" in df.columns:
-            df["rounds"] = df["Value"].apply(parse_count)
+            df["rounds"] = parse_count_series(df["Value"])
             df = df.dropna(subset=["rounds"])
             out["rounds"] = df[["run", "t_hours", "rounds"]]
 
     # Evaluation return (for RL / PPO experiments)
-    eval_return_file = find_first(run_dir, EVAL_RETURN_PREFIX)
+    eval_return_file = files.get(EVAL_RETURN_PREFIX)
     if eval_return_file:
-        df = pd.read_csv(eval_return_file)
+        df = read_csv(eval_return_file)
         df = add_time_offset(df, run)
         # Handle both single-value and join-by-field formats
         if "Value" in df.columns:
@@ -499,8 +706,15 @@ def clean_run(run_dir: Path) -> Dict[str, pd.DataFrame]:
     return out
 
 
+def setup_logging(verbose: bool) -> None:
+    logging.basicConfig(
+        level=logging.DEBUG if verbose else logging.WARNING, format="%(message)s"
+    )
+
+
 def main() -> None:
     args = parse_args()
+    setup_logging(args.verbose)
     input_base = Path(args.root).expanduser()
     output_base = Path(args.output).expanduser()
     output_base.mkdir(parents=True, exist_ok=True)
@@ -509,13 +723,25 @@ def main() -> None:
     if not runs:
         raise SystemExit(f"No run directories matched {args.glob} under {input_base}")
 
-    for run_dir in runs:
-        if not run_dir.is_dir():
-            continue
-
-        for key, df in clean_run(run_dir).items():
-            print(f"Writing {run_dir.name}-{key}.csv")
-            df.to_csv(output_base / f"{run_dir.name}-{key}.csv", index=False)
+    # Runs are independent, clean them in parallel and write the results in run order
+    run_dirs = [run_dir for run_dir in runs if run_dir.is_dir()]
+    # Spawned workers (macOS, Windows) don't inherit the logging setup
+    combined: Dict[str, List[pd.DataFrame]] = defaultdict(list)
+    with ProcessPoolExecutor(initializer=setup_logging, initargs=(args.verbose,)) as executor:
+        for run_dir, result in zip(run_dirs, executor.map(clean_run, run_dirs)):
+            for key, df in result.items():
+                if args.combine:
+                    combined[key].append(df)
+                    continue
+                log.info("Writing %s-%s.%s", run_dir.name, key, args.format)
+                write_output(df, output_base / f"{run_dir.name}-{key}.{args.format}")
+
+    for key, frames in combined.items():
+        df = pd.concat(frames, ignore_index=True)
+        # Each run's frame has its own single-category run column, concat falls back to object
+        df["run"] = df["run"].astype("category")
+        log.info("Writing %s.%s (%d runs)", key, args.format, len(frames))
+        write_output(df, output_base / f"{key}.{args.format}")
 
     print(f"Wrote cleaned metrics to {output_base}")
 